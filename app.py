@@ -1,47 +1,141 @@
-from flask import Flask, render_template, request, jsonify
-from pyBCRAdata.client import BCRAclient
+from flask import Flask, render_template, request, Response
 from afip import Afip
-import pandas as pd
+from cachetools import TTLCache
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache, lru_cache
+import hashlib
+import pathlib
+import logging
+import logging.handlers
+import queue
+import json
+import threading
 import traceback
 import os
-from sheets_helper import save_consultation, get_spreadsheet_url
+from bcra_helper import fetch_debtors, fetch_history, normalize
+from sheets_helper import init_sheets_once, save_consultation, get_spreadsheet_url
 
 app = Flask(__name__)
 
-# Initialize BCRA Client
+# Error logging goes through a queue to a background listener thread, so an
+# error spike (e.g. BCRA downtime) never serializes request threads on the
+# disk write to error.log.
+_log_queue = queue.Queue(-1)
+_log_handler = logging.handlers.RotatingFileHandler('error.log', maxBytes=50_000_000, backupCount=5)
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+_log_listener = None
+
+
+def _start_log_listener():
+    global _log_listener
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+
+
+_start_log_listener()
+# gunicorn preloads the app, and threads don't survive fork: without this
+# hook the listener would run only in the master while workers enqueue
+# records nothing ever drains.
+os.register_at_fork(after_in_child=_start_log_listener)
+logger = logging.getLogger('comarfin')
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.setLevel(logging.INFO)
+
+
 try:
-    client = BCRAclient()
-except Exception as e:
-    print(f"Error initializing BCRA client: {e}")
-    client = None
+    import orjson
+except ImportError:  # optional speedup; stdlib json keeps everything working
+    orjson = None
+
+try:
+    import redis
+except ImportError:  # optional L2 cache; in-process caches still work alone
+    redis = None
+
+# Redis L2 cache shared across workers, enabled via REDIS_URL. Timeouts are
+# aggressive and every operation is best-effort: Redis being down degrades
+# to per-worker caching, never to errors.
+_redis = None
+if redis is not None and os.environ.get('REDIS_URL'):
+    try:
+        _redis = redis.Redis.from_url(
+            os.environ['REDIS_URL'],
+            socket_timeout=0.05,
+            socket_connect_timeout=0.05,
+        )
+    except Exception as e:
+        print(f"Error initializing Redis: {e}")
+        _redis = None
+
+
+def _l2_get(key):
+    """Best-effort fetch of a jsonable value from the shared Redis cache."""
+    if _redis is None:
+        return None
+    try:
+        raw = _redis.get(key)
+        if raw is not None:
+            return (orjson or json).loads(raw)
+    except Exception:
+        pass
+    return None
+
+
+def _l2_set(key, value, ttl):
+    """Best-effort store of a jsonable value into the shared Redis cache."""
+    if _redis is None:
+        return
+    try:
+        _redis.setex(key, ttl, (orjson or json).dumps(value))
+    except Exception:
+        pass
+
+
+def ojsonify(obj):
+    """
+    Serialize a response body with orjson when available.
+
+    orjson is 2-5x faster than the stdlib encoder and emits bytes directly,
+    which matters for /check_score responses carrying dozens of debt records.
+    """
+    if orjson is not None:
+        body = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(obj)
+    return Response(body, mimetype='application/json')
 
 # Initialize AFIP SDK (Production mode with AFIP certificate)
 AFIP_ACCESS_TOKEN = os.environ.get('AFIP_ACCESS_TOKEN', 'qGfm4QDkgugrJrxdw5YDHpfdrBhxwCYH4x3AcwgoavFCjfK4CWBD2lIfE3HjcpN3')
 AFIP_CUIT = 20289107364  # Production CUIT
 
-# Load cert and key from env vars (Render) or local files
-afip_cert = os.environ.get('AFIP_CERT', None)
-afip_key = os.environ.get('AFIP_KEY', None)
+# Cert and key come from env vars (Render) or local files; the env-var path
+# skips the filesystem probe entirely and the cached value is shared
+# copy-on-write with every worker under preload_app.
+@cache
+def _load_cert():
+    cert = os.environ.get('AFIP_CERT')
+    if cert:
+        return cert
+    path = pathlib.Path(__file__).with_name('comarfin.crt')
+    return path.read_text() if path.exists() else None
 
-if not afip_cert:
-    cert_path = os.path.join(os.path.dirname(__file__), 'comarfin.crt')
-    if os.path.exists(cert_path):
-        with open(cert_path, 'r') as f:
-            afip_cert = f.read()
 
-if not afip_key:
-    key_path = os.path.join(os.path.dirname(__file__), 'comarfin.key')
-    if os.path.exists(key_path):
-        with open(key_path, 'r') as f:
-            afip_key = f.read()
+@cache
+def _load_key():
+    key = os.environ.get('AFIP_KEY')
+    if key:
+        return key
+    path = pathlib.Path(__file__).with_name('comarfin.key')
+    return path.read_text() if path.exists() else None
+
 
 try:
     afip_config = {
         "CUIT": AFIP_CUIT,
         "access_token": AFIP_ACCESS_TOKEN,
         "production": True,
-        "cert": afip_cert,
-        "key": afip_key,
+        "cert": _load_cert(),
+        "key": _load_key(),
     }
     afip_client = Afip(afip_config)
     print("AFIP client initialized in PRODUCTION mode")
@@ -49,6 +143,119 @@ except Exception as e:
     print(f"Error initializing AFIP client: {e}")
     afip_client = None
 
+# One-time Sheets header bootstrap, kept off the write path entirely.
+# Failure must never block boot; the check just reruns on the next start.
+try:
+    init_sheets_once()
+except Exception as e:
+    print(f"Error initializing Google Sheets: {e}")
+
+# Check-digit multipliers for CUIL/CUIT validation (shared by every call)
+_MULT = (5, 4, 3, 2, 7, 6, 5, 4, 3, 2)
+
+# In-process TTL caches for upstream lookups, keyed by CUIT. The UI queries
+# score, then history, then AFIP for the same person, and operators often
+# re-query the same DNI — a warm hit skips a 200-2000 ms upstream RTT.
+_score_cache = TTLCache(maxsize=10_000, ttl=600)
+_hist_cache = TTLCache(maxsize=10_000, ttl=600)
+_afip_cache = TTLCache(maxsize=10_000, ttl=900)
+_cache_lock = threading.Lock()
+
+# Dispatch pool for bulk lookups; sized to match the keep-alive connections
+# the shared BCRA session can hold open.
+_bulk_pool = ThreadPoolExecutor(max_workers=16)
+
+# In-flight futures so concurrent identical lookups (two tabs querying the
+# same CUIT) share one upstream call instead of both hitting BCRA/AFIP.
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _cached_fetch(cache, key, fetch, l2_prefix=None):
+    """
+    Return the cached upstream result for key, calling fetch() on a miss.
+
+    Lookup order is L1 (in-process TTLCache) then, when l2_prefix is given,
+    the shared Redis L2, then the upstream. Concurrent misses for the same
+    key are coalesced: the first caller performs the fetch while the rest
+    wait on its Future. Transient upstream errors (anything other than
+    200/404 on BCRA-style dicts) are not stored, so a flaky upstream can't
+    poison either cache level.
+    """
+    with _cache_lock:
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+    flight_key = (id(cache), key)
+    with _inflight_lock:
+        fut = _inflight.get(flight_key)
+        if fut is None:
+            fut = Future()
+            _inflight[flight_key] = fut
+            owner = True
+        else:
+            owner = False
+
+    if not owner:
+        return fut.result(timeout=30)
+
+    l2_key = f'{l2_prefix}:{key}' if l2_prefix else None
+    try:
+        value = _l2_get(l2_key) if l2_key else None
+        from_l2 = value is not None
+        if not from_l2:
+            value = fetch()
+        fut.set_result(value)
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(flight_key, None)
+
+    # Upstream status codes are ints (raw BCRA bodies); app-level payloads
+    # use string statuses ('success', 'no_data', ...) and are always cacheable.
+    status = value.get('status') if isinstance(value, dict) else None
+    if not (isinstance(status, int) and status not in (200, 404)):
+        with _cache_lock:
+            cache[key] = value
+        if l2_key and not from_l2:
+            _l2_set(l2_key, value, int(getattr(cache, 'ttl', 600)))
+    return value
+
+
+def _to_int(value):
+    """Coerce a BCRA field to int, treating missing/garbage values as 0."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _to_float(value):
+    """Coerce a BCRA field to float, treating missing/garbage values as 0."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _check_digit(base):
+    """Weighted mod-11 check digit over the first 10 digits of a CUIT/CUIL."""
+    total = sum(m * (b - 48) for m, b in zip(_MULT, base.encode()))
+    cd = 11 - total % 11
+    return 0 if cd == 11 else cd
+
+
+def _validate_cuit(cuit):
+    """True if cuit is an 11-digit CUIT/CUIL with a valid check digit."""
+    if len(cuit) != 11 or not cuit.isdigit():
+        return False
+    return _check_digit(cuit) == ord(cuit[10]) - 48
+
+
 def calculate_cuil(dni, gender):
     """
     Calculates the CUIL for a given DNI and Gender.
@@ -59,10 +266,14 @@ def calculate_cuil(dni, gender):
     """
     if not dni or not gender:
         return None
-    
-    dni = str(dni).strip()
-    gender = gender.upper()
-    
+
+    # Normalize here so the memoized implementation sees canonical keys
+    # (retries with the same DNI are a dict lookup, not a recomputation)
+    return _cuil_impl(str(dni).strip(), gender.upper())
+
+
+@lru_cache(maxsize=8192)
+def _cuil_impl(dni, gender):
     if len(dni) > 8 or len(dni) < 7:
          # Assume if it's already 11 digits, it's a CUIL
          if len(dni) == 11:
@@ -82,206 +293,237 @@ def calculate_cuil(dni, gender):
         # For 'X' or others, 23 is often used for generic/n-b
         prefix = '23' 
         
-    base = prefix + dni
-    
-    # Calculate check digit
-    multipliers = [5, 4, 3, 2, 7, 6, 5, 4, 3, 2]
-    total = 0
-    for i in range(10):
-        total += int(base[i]) * multipliers[i]
-        
-    remainder = total % 11
-    check_digit = 11 - remainder
-    
-    if check_digit == 11:
-        check_digit = 0
-    elif check_digit == 10:
-        # Special case: logic varies. 
+    check_digit = _check_digit(prefix + dni)
+
+    if check_digit == 10:
+        # Special case: logic varies.
         # Standard: If calculated digit is 10, prefix usually changes (M->23, F->23).
         # We will try switching to 23 and recalculating for M/F.
-        if gender in ['M', 'F'] and prefix != '23':
+        if gender in ('M', 'F') and prefix != '23':
             prefix = '23'
-            base = prefix + dni
-            total = 0
-            for i in range(10):
-                total += int(base[i]) * multipliers[i]
-            remainder = total % 11
-            check_digit = 11 - remainder
-            if check_digit == 11: check_digit = 0
+            check_digit = _check_digit(prefix + dni)
             # If it's still 10, it's a rare edge case, but 23 usually resolves it.
-        
+
     return f"{prefix}{dni}{check_digit}"
 
+# index.html takes no template parameters, so render it once at import time
+# and serve the cached bytes with a strong ETag; repeat visits get a 304
+# without touching Jinja at all.
+with app.app_context():
+    _INDEX_HTML = render_template('index.html').encode()
+_INDEX_ETAG = '"' + hashlib.md5(_INDEX_HTML).hexdigest() + '"'
+
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    if request.headers.get('If-None-Match') == _INDEX_ETAG:
+        return Response(status=304, headers={'ETag': _INDEX_ETAG})
+    return Response(_INDEX_HTML, mimetype='text/html',
+                    headers={'Cache-Control': 'public, max-age=300', 'ETag': _INDEX_ETAG})
+
+def _resolve_cuit(dni, sex):
+    """Resolve an input DNI/CUIT to a final CUIT, or (None, error message)."""
+    if not dni:
+        return None, 'DNI is required'
+
+    # Attempt to use as CUIT if passes length check or calculate from DNI.
+    # Rejecting a bad check digit here avoids a pointless upstream call.
+    if len(str(dni)) >= 10:
+        cuit = str(dni).strip()
+        if not _validate_cuit(cuit):
+            return None, 'CUIT inválido. Verifique el número ingresado.'
+        return cuit, None
+    if not sex:
+        return None, 'Sexo es requerido para calcular el CUIL desde el DNI.'
+    calculated = calculate_cuil(dni, sex)
+    if calculated:
+        return calculated, None
+    return None, 'No se pudo calcular el CUIL. Verifique el DNI.'
+
+
+def _score_payload(final_cuit):
+    """Fetch debts for a CUIT and build the score response payload."""
+    # Fetch data from BCRA using the calculated or provided CUIT
+    resp = normalize(_cached_fetch(_score_cache, final_cuit, lambda: fetch_debtors(final_cuit),
+                                         l2_prefix='bcra:score'))
+
+    if resp.status == 200:
+        records = resp.records
+
+        if not records:
+            return {
+                'status': 'no_data',
+                'message': f'No se encontraron datos para el CUIT {final_cuit}.',
+                'calculated_cuit': final_cuit
+            }, 200
+
+        # Calculate a "summary" status if there are multiple debts
+        max_situation = max(
+            (_to_int(r.get('periodos_entidades_situacion')) for r in records),
+            default=0
+        )
+
+        return {
+            'status': 'success',
+            'data': records,
+            'summary_situation': max_situation,
+            'calculated_cuit': final_cuit
+        }, 200
+    elif resp.status == 404:
+        # 404 means no debts found - this is a VALID result (person has no credit issues)
+        return {
+            'status': 'no_data',
+            'message': f'No se encontraron deudas para el CUIT {final_cuit}. (Sin registros en Central de Deudores)',
+            'calculated_cuit': final_cuit
+        }, 200
+    else:
+        # Other API errors
+        return {
+            'error': f'Error del BCRA (código {resp.status})',
+            'details': '; '.join(resp.errors) if resp.errors else f'status {resp.status}'
+        }, 500
+
 
 @app.route('/check_score', methods=['POST'])
 def check_score():
-    if not client:
-        return jsonify({'error': 'BCRA client not initialized'}), 500
-
     data = request.json
     dni = data.get('dni')
     sex = data.get('sex') # M, F, X
-    
+
     # Optional fields for display or logging
     name = data.get('name')
 
-    if not dni:
-        return jsonify({'error': 'DNI is required'}), 400
-        
-    # Attempt to use as CUIT if passes length check or calculate from DNI
-    final_cuit = dni
-    if len(str(dni)) < 10:
-        if not sex:
-             return jsonify({'error': 'Sexo es requerido para calcular el CUIL desde el DNI.'}), 400
-        
-        calculated = calculate_cuil(dni, sex)
-        if calculated:
-            final_cuit = calculated
-        else:
-            return jsonify({'error': 'No se pudo calcular el CUIL. Verifique el DNI.'}), 400
+    final_cuit, error = _resolve_cuit(dni, sex)
+    if error:
+        return ojsonify({'error': error}), 400
 
     try:
-        # Fetch data from BCRA using the calculated or provided CUIT
-        result = client.debtors.debtors(identificacion=final_cuit)
-
-        if isinstance(result, pd.DataFrame):
-            if result.empty:
-                 return jsonify({
-                     'status': 'no_data', 
-                     'message': f'No se encontraron datos para el CUIT {final_cuit}.',
-                     'calculated_cuit': final_cuit
-                 })
-            
-            # Convert DataFrame to list of dicts for JSON response
-            records = result.to_dict(orient='records')
-            
-            # Calculate a "summary" status if there are multiple debts
-            max_situation = 0
-            for record in records:
-                try:
-                    sit = int(record.get('periodos_entidades_situacion', 1))
-                    if sit > max_situation:
-                        max_situation = sit
-                except:
-                    pass
-            
-            return jsonify({
-                'status': 'success',
-                'data': records,
-                'summary_situation': max_situation,
-                'calculated_cuit': final_cuit
-            })
-        elif isinstance(result, dict):
-             # pyBCRA returns a dict when no data is found (404) or other API errors
-             status_code = result.get('status', 0)
-             error_msgs = result.get('errorMessages', [])
-             
-             if status_code == 404:
-                 # 404 means no debts found - this is a VALID result (person has no credit issues)
-                 return jsonify({
-                     'status': 'no_data',
-                     'message': f'No se encontraron deudas para el CUIT {final_cuit}. (Sin registros en Central de Deudores)',
-                     'calculated_cuit': final_cuit
-                 })
-             else:
-                 # Other API errors
-                 return jsonify({
-                     'error': f'Error del BCRA (código {status_code})',
-                     'details': '; '.join(error_msgs) if error_msgs else str(result)
-                 }), 500
-        else:
-             return jsonify({'error': 'Respuesta inesperada del BCRA', 'details': str(type(result))}), 500
-
+        payload, status = _score_payload(final_cuit)
+        return ojsonify(payload), status
     except Exception as e:
-        with open("error.log", "a") as f:
-            f.write(f"Error processing check_score for input {data}:\n")
-            traceback.print_exc(file=f)
-            f.write("\n" + "-"*20 + "\n")
+        logger.exception("check_score failed for input %s", data)
         traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}), 500
+
+
+@app.route('/check_score_bulk', methods=['POST'])
+def check_score_bulk():
+    """
+    Check scores for a pasted list of DNIs in a single request.
+
+    The lookups run concurrently on a small thread pool over the shared
+    keep-alive BCRA session, so a batch of N pays for one connection and
+    one HTTP request from the browser instead of N of each. Duplicate
+    CUITs in the batch are coalesced onto a single upstream call.
+    """
+    data = request.json
+    items = data.get('items') if data else None
+    if not isinstance(items, list) or not items:
+        return ojsonify({'error': 'Se requiere una lista "items" de consultas'}), 400
+    if len(items) > 64:
+        return ojsonify({'error': 'Máximo 64 consultas por lote'}), 400
+    if not all(isinstance(item, dict) for item in items):
+        return ojsonify({'error': 'Cada entrada debe ser un objeto {"dni", "sex"}'}), 400
+
+    def lookup(item):
+        final_cuit, error = _resolve_cuit(item.get('dni'), item.get('sex'))
+        if error:
+            return {'error': error, 'dni': item.get('dni')}
+        try:
+            payload, _ = _score_payload(final_cuit)
+            return payload
+        except Exception as e:
+            return {'error': str(e), 'dni': item.get('dni')}
+
+    results = list(_bulk_pool.map(lookup, items))
+    return ojsonify({'status': 'success', 'results': results})
+
+@app.route('/calc_cuils', methods=['POST'])
+def calc_cuils():
+    """
+    Calculate CUILs for a batch of DNIs in a single request.
+
+    Accepts {"items": [{"dni": ..., "sex": ...}, ...]} and returns the
+    CUIL (or null) per entry in order, so a pasted list of 10k DNIs costs
+    one HTTP round-trip instead of one per DNI. No upstream calls are
+    made; this is pure local arithmetic.
+    """
+    data = request.json
+    items = data.get('items') if data else None
+    if not isinstance(items, list) or not items:
+        return ojsonify({'error': 'Se requiere una lista "items" de consultas'}), 400
+    if len(items) > 10_000:
+        return ojsonify({'error': 'Máximo 10000 entradas por lote'}), 400
+    if not all(isinstance(item, dict) for item in items):
+        return ojsonify({'error': 'Cada entrada debe ser un objeto {"dni", "sex"}'}), 400
+
+    cuils = [calculate_cuil(item.get('dni'), item.get('sex')) for item in items]
+    return ojsonify({'status': 'success', 'cuils': cuils})
+
 
 @app.route('/check_history', methods=['POST'])
 def check_history():
     """Fetch 6-month debt history for a CUIT"""
-    if not client:
-        return jsonify({'error': 'BCRA client not initialized'}), 500
-
     data = request.json
     cuit = data.get('cuit')
 
     if not cuit:
-        return jsonify({'error': 'CUIT is required'}), 400
+        return ojsonify({'error': 'CUIT is required'}), 400
+
+    cuit = str(cuit).strip()
+    if not _validate_cuit(cuit):
+        return ojsonify({'error': 'CUIT inválido. Verifique el número ingresado.'}), 400
 
     try:
-        result = client.debtors.history(identificacion=cuit)
+        resp = normalize(_cached_fetch(_hist_cache, cuit, lambda: fetch_history(cuit), l2_prefix='bcra:hist'))
 
-        if isinstance(result, pd.DataFrame):
-            if result.empty:
-                return jsonify({'status': 'no_history', 'message': 'Sin historial disponible.'})
+        if resp.status == 200:
+            records = resp.records
 
-            # Get last 6 periods (months)
-            periods = sorted(result['periodos_periodo'].unique(), reverse=True)[:6]
-            
+            if not records:
+                return ojsonify({'status': 'no_history', 'message': 'Sin historial disponible.'})
+
+            # Aggregate per period in a single pass: [worst_situation, total_debt, num_entities]
+            buckets = {}
+            for r in records:
+                bucket = buckets.setdefault(str(r.get('periodos_periodo')), [0, 0.0, 0])
+                bucket[0] = max(bucket[0], _to_int(r.get('periodos_entidades_situacion')))
+                bucket[1] += _to_float(r.get('periodos_entidades_monto'))
+                bucket[2] += 1
+
+            # Keep the last 6 periods (months)
             history_summary = []
-            for period in periods:
-                period_data = result[result['periodos_periodo'] == period]
-                
-                # Worst situation in this period
-                worst_sit = 0
-                try:
-                    worst_sit = int(period_data['periodos_entidades_situacion'].max())
-                except:
-                    worst_sit = 0
-                
-                # Total debt in this period
-                total_debt = 0
-                try:
-                    total_debt = float(period_data['periodos_entidades_monto'].sum())
-                except:
-                    total_debt = 0
-                
-                # Number of entities
-                num_entities = len(period_data)
-                
+            for period_str, (worst_sit, total_debt, num_entities) in sorted(buckets.items(), reverse=True)[:6]:
                 # Format period YYYYMM -> YYYY-MM
-                period_str = str(period)
                 formatted_period = f"{period_str[:4]}-{period_str[4:]}" if len(period_str) == 6 else period_str
-                
+
                 history_summary.append({
                     'period': formatted_period,
                     'worst_situation': worst_sit,
                     'total_debt': total_debt,
                     'num_entities': num_entities
                 })
-            
-            return jsonify({
+
+            return ojsonify({
                 'status': 'success',
                 'history': history_summary,
-                'person_name': result['denominacion'].iloc[0] if 'denominacion' in result.columns else 'N/A'
+                'person_name': records[0].get('denominacion', 'N/A')
             })
 
-        elif isinstance(result, dict):
-            status_code = result.get('status', 0)
-            if status_code == 404:
-                return jsonify({'status': 'no_history', 'message': 'Sin historial de deudas registrado.'})
-            else:
-                error_msgs = result.get('errorMessages', [])
-                return jsonify({'error': f'Error del BCRA ({status_code})', 'details': '; '.join(error_msgs)}), 500
+        elif resp.status == 404:
+            return ojsonify({'status': 'no_history', 'message': 'Sin historial de deudas registrado.'})
         else:
-            return jsonify({'error': 'Respuesta inesperada', 'details': str(type(result))}), 500
+            return ojsonify({'error': f'Error del BCRA ({resp.status})', 'details': '; '.join(resp.errors)}), 500
 
     except Exception as e:
         traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}), 500
 
 @app.route('/check_afip', methods=['POST'])
 def check_afip():
     """Query AFIP for taxpayer tax status (monotributo, IVA, etc.)"""
     if not afip_client:
-        return jsonify({'error': 'AFIP client not initialized'}), 500
+        return ojsonify({'error': 'AFIP client not initialized'}), 500
 
     data = request.json
     dni = data.get('dni')
@@ -291,151 +533,165 @@ def check_afip():
     # Calculate CUIT from DNI if not provided
     if not cuit:
         if not dni:
-            return jsonify({'error': 'DNI o CUIT es requerido'}), 400
+            return ojsonify({'error': 'DNI o CUIT es requerido'}), 400
         if not sex:
-            return jsonify({'error': 'Sexo es requerido para calcular el CUIL'}), 400
+            return ojsonify({'error': 'Sexo es requerido para calcular el CUIL'}), 400
         cuit = calculate_cuil(dni, sex)
         if not cuit:
-            return jsonify({'error': 'No se pudo calcular el CUIL'}), 400
+            return ojsonify({'error': 'No se pudo calcular el CUIL'}), 400
+    else:
+        cuit = str(cuit).strip()
+        if not _validate_cuit(cuit):
+            return ojsonify({'error': 'CUIT inválido. Verifique el número ingresado.'}), 400
 
     try:
-        taxpayer = afip_client.RegisterInscriptionProof.getTaxpayerDetails(int(cuit))
-
-        if not taxpayer:
-            return jsonify({'status': 'no_data', 'message': 'No se encontraron datos en AFIP.', 'cuit': cuit})
-
-        # Check for errorConstancia (partial data)
-        if 'errorConstancia' in taxpayer and 'datosGenerales' not in taxpayer:
-            error_data = taxpayer['errorConstancia']
-            nombre = error_data.get('nombre', '')
-            apellido = error_data.get('apellido', '')
-            errors = error_data.get('error', [])
-            return jsonify({
-                'status': 'partial',
-                'cuit': cuit,
-                'nombre': f"{nombre} {apellido}".strip() or 'N/A',
-                'errors': errors,
-                'message': 'Datos parciales - la constancia tiene observaciones'
-            })
-
-        # Extract general data
-        datos_gen = taxpayer.get('datosGenerales', {})
-        nombre = datos_gen.get('nombre', '')
-        apellido = datos_gen.get('apellido', '')
-        razon_social = datos_gen.get('razonSocial', '')
-        full_name = razon_social if razon_social else f"{nombre} {apellido}".strip()
-        estado_clave = datos_gen.get('estadoClave', 'N/A')
-        tipo_persona = datos_gen.get('tipoPersona', 'N/A')
-
-        # Determine tax condition
-        condition = 'Sin datos'
-        category = None
-        is_monotributo = False
-        is_responsable_inscripto = False
-        is_relacion_dependencia = False
-        is_autonomo = False
-
-        # Check monotributo
-        datos_mono = taxpayer.get('datosMonotributo', {})
-        if datos_mono:
-            mono_impuestos = datos_mono.get('impuesto', [])
-            for imp in mono_impuestos:
-                if imp.get('idImpuesto') == 20 and imp.get('estadoImpuesto') == 'AC':
-                    is_monotributo = True
-                    cat_mono = datos_mono.get('categoriaMonotributo', {})
-                    category = cat_mono.get('descripcionCategoria', 'N/A')
-                    break
-
-        # Check regimen general
-        datos_rg = taxpayer.get('datosRegimenGeneral', {})
-        if datos_rg:
-            rg_impuestos = datos_rg.get('impuesto', [])
-            for imp in rg_impuestos:
-                desc = imp.get('descripcionImpuesto', '').upper()
-                estado = imp.get('estadoImpuesto', '')
-                if estado == 'AC':
-                    if 'IVA' in desc and imp.get('idImpuesto') == 30:
-                        is_responsable_inscripto = True
-                    if 'AUTONOMO' in desc or 'AUTÓNOMO' in desc:
-                        is_autonomo = True
-
-        # Check activities for relacion de dependencia
-        all_activities = []
-        for section in ['datosMonotributo', 'datosRegimenGeneral']:
-            sec_data = taxpayer.get(section, {})
-            activities = sec_data.get('actividad', [])
-            for act in activities:
-                desc_act = act.get('descripcionActividad', '')
-                all_activities.append(desc_act)
-                if 'RELAC' in desc_act.upper() and 'DEPENDENCIA' in desc_act.upper():
-                    is_relacion_dependencia = True
-
-        # Determine condition label
-        conditions = []
-        if is_monotributo:
-            conditions.append(f'Monotributista ({category})' if category else 'Monotributista')
-        if is_responsable_inscripto:
-            conditions.append('Responsable Inscripto')
-        if is_relacion_dependencia:
-            conditions.append('Relacion de Dependencia')
-        if is_autonomo:
-            conditions.append('Autonomo')
-
-        # If no tax inscriptions found, indicate it clearly
-        if not conditions:
-            if not datos_mono and not datos_rg:
-                condition = 'Sin inscripciones activas — Posible empleado en relación de dependencia, jubilado o sin actividad registrada'
-            else:
-                condition = 'Sin condicion activa detectada'
-        else:
-            condition = ' | '.join(conditions)
-
-        # Get domicilio
-        domicilio = datos_gen.get('domicilioFiscal', {})
-        domicilio_str = ''
-        if domicilio:
-            parts = [domicilio.get('direccion', ''), domicilio.get('localidad', ''), 
-                     domicilio.get('descripcionProvincia', ''), domicilio.get('codPostal', '')]
-            domicilio_str = ', '.join(p for p in parts if p)
-
-        # Collect all impuestos
-        all_impuestos = []
-        for section in ['datosMonotributo', 'datosRegimenGeneral']:
-            sec_data = taxpayer.get(section, {})
-            for imp in sec_data.get('impuesto', []):
-                all_impuestos.append({
-                    'descripcion': imp.get('descripcionImpuesto', 'N/A'),
-                    'estado': 'Activo' if imp.get('estadoImpuesto') == 'AC' else 'Inactivo',
-                    'periodo': imp.get('periodo', 'N/A')
-                })
-
-        return jsonify({
-            'status': 'success',
-            'cuit': cuit,
-            'nombre': full_name,
-            'estado_clave': estado_clave,
-            'tipo_persona': tipo_persona,
-            'condicion_fiscal': condition,
-            'is_monotributo': is_monotributo,
-            'is_responsable_inscripto': is_responsable_inscripto,
-            'is_relacion_dependencia': is_relacion_dependencia,
-            'is_autonomo': is_autonomo,
-            'categoria_monotributo': category,
-            'domicilio': domicilio_str,
-            'actividades': list(set(all_activities))[:10],
-            'impuestos': all_impuestos
-        })
-
+        payload = _cached_fetch(_afip_cache, cuit, lambda: _afip_payload(cuit),
+                                l2_prefix='afip:resp')
+        return ojsonify(payload)
     except Exception as e:
         error_msg = str(e)
         if 'No existe persona' in error_msg:
-            return jsonify({
+            return ojsonify({
                 'status': 'not_found',
                 'cuit': cuit,
                 'message': f'No se encontro persona con CUIT {cuit} en AFIP'
             })
         traceback.print_exc()
-        return jsonify({'error': error_msg}), 500
+        return ojsonify({'error': error_msg}), 500
+
+
+def _afip_payload(cuit):
+    """
+    Query AFIP and build the complete response payload for a CUIT.
+
+    The caller caches the returned dict, so a warm hit skips all of the
+    parsing below (impuesto classification, activity scan, joins) along
+    with the network call — not just the round-trip.
+    """
+    taxpayer = afip_client.RegisterInscriptionProof.getTaxpayerDetails(int(cuit))
+
+    if not taxpayer:
+        return {'status': 'no_data', 'message': 'No se encontraron datos en AFIP.', 'cuit': cuit}
+
+    # Check for errorConstancia (partial data)
+    if 'errorConstancia' in taxpayer and 'datosGenerales' not in taxpayer:
+        error_data = taxpayer['errorConstancia']
+        nombre = error_data.get('nombre', '')
+        apellido = error_data.get('apellido', '')
+        errors = error_data.get('error', [])
+        return {
+            'status': 'partial',
+            'cuit': cuit,
+            'nombre': f"{nombre} {apellido}".strip() or 'N/A',
+            'errors': errors,
+            'message': 'Datos parciales - la constancia tiene observaciones'
+        }
+
+    # Extract general data
+    datos_gen = taxpayer.get('datosGenerales', {})
+    nombre = datos_gen.get('nombre', '')
+    apellido = datos_gen.get('apellido', '')
+    razon_social = datos_gen.get('razonSocial', '')
+    full_name = razon_social if razon_social else f"{nombre} {apellido}".strip()
+    estado_clave = datos_gen.get('estadoClave', 'N/A')
+    tipo_persona = datos_gen.get('tipoPersona', 'N/A')
+
+    # Determine tax condition
+    condition = 'Sin datos'
+    category = None
+    is_monotributo = False
+    is_responsable_inscripto = False
+    is_relacion_dependencia = False
+    is_autonomo = False
+
+    datos_mono = taxpayer.get('datosMonotributo', {})
+    datos_rg = taxpayer.get('datosRegimenGeneral', {})
+
+    # Single walk over both sections: classify impuestos, collect the
+    # full impuesto list for the response, and scan activities — the
+    # previous version re-iterated each section three times.
+    all_activities = []
+    all_impuestos = []
+    for section_name, sec_data in (('datosMonotributo', datos_mono), ('datosRegimenGeneral', datos_rg)):
+        if not sec_data:
+            continue
+        for imp in sec_data.get('impuesto', []):
+            estado = imp.get('estadoImpuesto', '')
+            desc = imp.get('descripcionImpuesto', '')
+            desc_upper = desc.upper()
+            all_impuestos.append({
+                'descripcion': desc or 'N/A',
+                'estado': 'Activo' if estado == 'AC' else 'Inactivo',
+                'periodo': imp.get('periodo', 'N/A')
+            })
+            if estado != 'AC':
+                continue
+            if section_name == 'datosMonotributo':
+                if imp.get('idImpuesto') == 20 and not is_monotributo:
+                    is_monotributo = True
+                    cat_mono = sec_data.get('categoriaMonotributo', {})
+                    category = cat_mono.get('descripcionCategoria', 'N/A')
+            else:
+                if 'IVA' in desc_upper and imp.get('idImpuesto') == 30:
+                    is_responsable_inscripto = True
+                if 'AUTONOMO' in desc_upper or 'AUTÓNOMO' in desc_upper:
+                    is_autonomo = True
+        for act in sec_data.get('actividad', []):
+            desc_act = act.get('descripcionActividad', '')
+            # Only 10 deduped activities ever reach the response, so stop
+            # collecting past 32 — but keep scanning every activity for
+            # the relación de dependencia flag
+            if len(all_activities) < 32:
+                all_activities.append(desc_act)
+            desc_act_upper = desc_act.upper()
+            if 'RELAC' in desc_act_upper and 'DEPENDENCIA' in desc_act_upper:
+                is_relacion_dependencia = True
+
+    # Determine condition label
+    conditions = []
+    if is_monotributo:
+        conditions.append(f'Monotributista ({category})' if category else 'Monotributista')
+    if is_responsable_inscripto:
+        conditions.append('Responsable Inscripto')
+    if is_relacion_dependencia:
+        conditions.append('Relacion de Dependencia')
+    if is_autonomo:
+        conditions.append('Autonomo')
+
+    # If no tax inscriptions found, indicate it clearly
+    if not conditions:
+        if not datos_mono and not datos_rg:
+            condition = 'Sin inscripciones activas — Posible empleado en relación de dependencia, jubilado o sin actividad registrada'
+        else:
+            condition = 'Sin condicion activa detectada'
+    else:
+        condition = ' | '.join(conditions)
+
+    # Get domicilio
+    domicilio = datos_gen.get('domicilioFiscal', {})
+    domicilio_str = ''
+    if domicilio:
+        parts = [domicilio.get('direccion', ''), domicilio.get('localidad', ''), 
+                 domicilio.get('descripcionProvincia', ''), domicilio.get('codPostal', '')]
+        domicilio_str = ', '.join(p for p in parts if p)
+
+    return {
+        'status': 'success',
+        'cuit': cuit,
+        'nombre': full_name,
+        'estado_clave': estado_clave,
+        'tipo_persona': tipo_persona,
+        'condicion_fiscal': condition,
+        'is_monotributo': is_monotributo,
+        'is_responsable_inscripto': is_responsable_inscripto,
+        'is_relacion_dependencia': is_relacion_dependencia,
+        'is_autonomo': is_autonomo,
+        'categoria_monotributo': category,
+        'domicilio': domicilio_str,
+        'actividades': list(dict.fromkeys(all_activities))[:10],
+        'impuestos': all_impuestos
+    }
+
 
 @app.route('/save_to_sheets', methods=['POST'])
 def save_to_sheets():
@@ -443,25 +699,25 @@ def save_to_sheets():
     try:
         data = request.json
         if not data:
-            return jsonify({'error': 'No data provided'}), 400
+            return ojsonify({'error': 'No data provided'}), 400
 
         url = save_consultation(data)
-        return jsonify({
+        return ojsonify({
             'status': 'success',
             'message': 'Datos guardados en Google Sheets',
             'url': url
         })
     except Exception as e:
         traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}), 500
 
 @app.route('/sheets_url', methods=['GET'])
 def sheets_url():
     """Get the URL of the Google Sheets spreadsheet."""
     url = get_spreadsheet_url()
     if url:
-        return jsonify({'url': url})
-    return jsonify({'url': None})
+        return ojsonify({'url': url})
+    return ojsonify({'url': None})
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -0,0 +1,76 @@
+from dataclasses import dataclass, field
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+BCRA_BASE_URL = 'https://api.bcra.gob.ar/centraldedeudores/v1.0'
+
+# Shared session so every lookup reuses a keep-alive HTTPS connection
+# instead of paying a fresh TCP+TLS handshake per request. The pool is
+# sized for bursts of parallel lookups (bulk endpoint, threaded workers),
+# and transient upstream hiccups get two quick retries with backoff.
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=100,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504)),
+))
+
+
+def _get_json(url):
+    """GET a BCRA endpoint and return the parsed JSON body as a dict."""
+    resp = _session.get(url, timeout=30)
+    try:
+        body = resp.json()
+    except ValueError:
+        return {'status': resp.status_code, 'errorMessages': [resp.text[:200]]}
+    if 'status' not in body:
+        body['status'] = resp.status_code
+    return body
+
+
+def fetch_debtors(cuit):
+    """Fetch current debts for a CUIT from Central de Deudores."""
+    return _get_json(f'{BCRA_BASE_URL}/Deudas/{cuit}')
+
+
+def fetch_history(cuit):
+    """Fetch the 24-month debt history for a CUIT."""
+    return _get_json(f'{BCRA_BASE_URL}/Deudas/Historicas/{cuit}')
+
+
+@dataclass(slots=True)
+class BCRAResponse:
+    """Normalized Central de Deudores response: flat records plus status."""
+    records: list = field(default_factory=list)
+    status: int = 200
+    errors: tuple = ()
+
+
+def normalize(result):
+    """Normalize a raw BCRA JSON body into a BCRAResponse, flattening the
+    nested payload on success and collecting errorMessages otherwise."""
+    status = result.get('status', 0)
+    if status == 200:
+        return BCRAResponse(records=flatten_records(result.get('results') or {}))
+    return BCRAResponse(status=status, errors=tuple(result.get('errorMessages') or ()))
+
+
+def flatten_records(results):
+    """
+    Flatten the nested BCRA payload (periodos -> entidades) into a flat list
+    of dicts using the same column names the pyBCRA DataFrame exposed
+    (periodos_periodo, periodos_entidades_situacion, etc.) so the frontend
+    keeps working unchanged.
+    """
+    records = []
+    base = {k: v for k, v in results.items() if k != 'periodos'}
+    for periodo in results.get('periodos') or []:
+        for entidad in periodo.get('entidades') or []:
+            record = dict(base)
+            record['periodos_periodo'] = periodo.get('periodo')
+            for key, value in entidad.items():
+                record['periodos_entidades_' + key] = value
+            records.append(record)
+    return records
@@ -0,0 +1,12 @@
+# Gunicorn config for the Render deployment (see render.yaml).
+# The handlers are I/O-bound (BCRA/AFIP round-trips), so threaded workers
+# let each worker hold many in-flight upstream calls at once.
+workers = 4
+threads = 16
+worker_class = 'gthread'
+keepalive = 75
+timeout = 30
+
+# Import the app once in the master; the CUIL memo cache and client setup
+# are then shared with workers copy-on-write instead of duplicated.
+preload_app = True
@@ -1,166 +1,506 @@
-import gspread
-from google.oauth2.service_account import Credentials
+from collections import OrderedDict
 from datetime import datetime
+import functools
 import os
 import json
+import queue
+import random
+import threading
+import time
+
+try:
+    import orjson as _json
+except ImportError:  # stdlib json is fine, orjson just parses faster
+    _json = json
+
+# gspread and google-auth are imported lazily on first use: together they
+# drag in urllib3 + google-auth and dominate module import time, which
+# matters for cold starts of workers that never touch Sheets.
+gspread = None
+AuthorizedSession = None
+Request = None
+Credentials = None
+
+
+def _ensure_google_libs():
+    """Import the Google client libraries on first use."""
+    global gspread, AuthorizedSession, Request, Credentials
+    if gspread is None:
+        import gspread as _gspread
+        from google.auth.transport.requests import AuthorizedSession as _authed, Request as _request
+        from google.oauth2.service_account import Credentials as _credentials
+        gspread = _gspread
+        AuthorizedSession = _authed
+        Request = _request
+        Credentials = _credentials
 
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive'
 ]
 
+# ID of the spreadsheet shared by the user
+# Title: 'Comarfin users'
+SPREADSHEET_ID = '1ToLqnylV8AO_84Rk4tya0facoDJvxHwRfgTD1IRO9as'
+
+# The URL is a pure function of the ID — never worth an API call
+SPREADSHEET_URL = f'https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}'
+
 # Module-level cache
+_creds = None
 _gc = None
+_authed_session = None
 _spreadsheet_id = None
-SPREADSHEET_ID_FILE = os.path.join(os.path.dirname(__file__), '.sheets_id')
+_sh = None
+_ws = None
+_bootstrap_lock = threading.Lock()
+_MODULE_DIR = os.path.dirname(__file__)
+SPREADSHEET_ID_FILE = os.path.join(_MODULE_DIR, '.sheets_id')
+_CREDS_PATH = os.path.join(_MODULE_DIR, 'google_credentials.json')
+TOKEN_CACHE_FILE = '/tmp/.sheets_token'
 
 
-def _get_client():
-    """Get or create authenticated gspread client."""
-    global _gc
-    if _gc is not None:
-        return _gc
+def _retry_on_429(max_attempts=6, base=1.0, cap=90.0):
+    """
+    Retry a Sheets API call on 429/5xx with exponential backoff and jitter.
+
+    The Sheets write quota refills per minute, so a burst of consultations
+    can trip 429s; without retries those saves were simply lost. Honors
+    the Retry-After header when present, otherwise sleeps
+    min(cap, base * 2**attempt) plus jitter. Other errors re-raise
+    immediately.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    # gspread is imported lazily; anything raised before it
+                    # exists can't be an APIError
+                    if gspread is None or not isinstance(e, gspread.exceptions.APIError):
+                        raise
+                    response = getattr(e, 'response', None)
+                    status = getattr(response, 'status_code', None)
+                    if status not in (429, 500, 502, 503) or attempt == max_attempts - 1:
+                        raise
+                    retry_after = response.headers.get('Retry-After')
+                    try:
+                        # Retry-After may also be an HTTP-date; fall back
+                        # to exponential backoff rather than blowing up
+                        delay = min(cap, float(retry_after))
+                    except (TypeError, ValueError):
+                        delay = min(cap, base * 2 ** attempt) + random.uniform(0, base)
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
+
+def _get_credentials():
+    """Get or build the service-account credentials (cached per process)."""
+    global _creds
+    if _creds is not None:
+        return _creds
+
+    _ensure_google_libs()
 
     # Try env var first (for Render), then local file
     creds_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
     if creds_json:
-        creds_dict = json.loads(creds_json)
+        creds_dict = _json.loads(creds_json)
         creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
     else:
-        creds_path = os.path.join(os.path.dirname(__file__), 'google_credentials.json')
-        if not os.path.exists(creds_path):
+        if not os.path.exists(_CREDS_PATH):
             raise FileNotFoundError("Google credentials not found")
-        creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
+        creds = Credentials.from_service_account_file(_CREDS_PATH, scopes=SCOPES)
+
+    # Reuse the access token from a previous run when it's still valid;
+    # otherwise do the JWT exchange once and cache the result. Render
+    # restarts dynos often, and the exchange adds ~300 ms before the
+    # first write.
+    if not _load_cached_token(creds):
+        try:
+            creds.refresh(Request())
+            _store_cached_token(creds)
+        except Exception as e:
+            # gspread refreshes lazily on first use anyway
+            print(f"Error pre-refreshing Sheets token: {e}")
+
+    _creds = creds
+    return _creds
+
 
+def _get_client():
+    """Get or create authenticated gspread client."""
+    global _gc
+    if _gc is not None:
+        return _gc
+    creds = _get_credentials()  # also imports the Google libs
     _gc = gspread.authorize(creds)
     return _gc
 
 
+def _get_authed_session():
+    """AuthorizedSession with a keep-alive connection to the Sheets API."""
+    global _authed_session
+    if _authed_session is None:
+        creds = _get_credentials()  # also imports the Google libs
+        _authed_session = AuthorizedSession(creds)
+    return _authed_session
+
+
+def _load_cached_token(creds):
+    """Inject a cached access token into creds if it has >60 s of life left."""
+    try:
+        with open(TOKEN_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+        expiry = datetime.fromisoformat(cached['expiry'])
+        if (expiry - datetime.utcnow()).total_seconds() > 60:
+            creds.token = cached['token']
+            creds.expiry = expiry
+            return True
+    except (OSError, ValueError, KeyError):
+        pass
+    return False
+
+
+def _store_cached_token(creds):
+    """Persist the refreshed access token for the next cold start."""
+    try:
+        with open(TOKEN_CACHE_FILE, 'w') as f:
+            json.dump({'token': creds.token, 'expiry': creds.expiry.isoformat()}, f)
+        os.chmod(TOKEN_CACHE_FILE, 0o600)
+    except OSError:
+        pass
+
+
+_state_cache = None
+
+
+def _load_state():
+    """Read the {id, header_ok} state, memory-first (legacy files hold a bare id)."""
+    global _state_cache
+    if _state_cache is not None:
+        return _state_cache
+
+    state = {}
+    if os.path.exists(SPREADSHEET_ID_FILE):
+        with open(SPREADSHEET_ID_FILE, 'r') as f:
+            raw = f.read().strip()
+        if raw.startswith('{'):
+            try:
+                state = json.loads(raw)
+            except ValueError:
+                state = {}
+        elif raw:
+            state = {'id': raw, 'header_ok': False}
+    _state_cache = state
+    return _state_cache
+
+
+def _save_state(sid, header_ok):
+    """Write-through the spreadsheet ID and header flag; skip disk if unchanged."""
+    global _spreadsheet_id, _state_cache
+    _spreadsheet_id = sid
+    new_state = {'id': sid, 'header_ok': bool(header_ok)}
+    if _state_cache == new_state:
+        return
+    _state_cache = new_state
+    with open(SPREADSHEET_ID_FILE, 'w') as f:
+        json.dump(new_state, f)
+
+
 def _get_spreadsheet_id():
     """Get the stored spreadsheet ID."""
     global _spreadsheet_id
     if _spreadsheet_id:
         return _spreadsheet_id
+    _spreadsheet_id = _load_state().get('id')
+    return _spreadsheet_id
 
-    if os.path.exists(SPREADSHEET_ID_FILE):
-        with open(SPREADSHEET_ID_FILE, 'r') as f:
-            _spreadsheet_id = f.read().strip()
-            return _spreadsheet_id
-    return None
 
+@_retry_on_429()
+def _open_worksheet():
+    """Open the shared spreadsheet once and cache the worksheet handle."""
+    global _sh, _ws
+    if _ws is not None:
+        return _ws
+
+    with _bootstrap_lock:
+        if _ws is not None:
+            return _ws
+
+        gc = _get_client()
+        try:
+            _sh = gc.open_by_key(SPREADSHEET_ID)
+            _ws = _sh.sheet1
+            return _ws
+        except Exception as e:
+            # Fallback if specific sheet differs or fails
+            print(f"Error accessing shared sheet: {e}")
+            # If we can't search by name easily without listing all, we might fallback to create
+            # But for now, let's Raise to see what happens or try to find by name if key fails
+            raise e
 
-def _save_spreadsheet_id(sid):
-    """Save spreadsheet ID to file."""
-    global _spreadsheet_id
-    _spreadsheet_id = sid
-    with open(SPREADSHEET_ID_FILE, 'w') as f:
-        f.write(sid)
+
+@_retry_on_429()
+def init_sheets_once():
+    """
+    Ensure the header row exists and is formatted; call once at app startup.
+
+    The probe runs exactly once per spreadsheet: after the first success
+    the header_ok flag persisted in .sheets_id short-circuits it, even
+    across restarts, so the write path never pays the acell GET or the
+    format/freeze calls.
+    """
+    state = _load_state()
+    if state.get('id') == SPREADSHEET_ID and state.get('header_ok'):
+        return
+
+    ws = _open_worksheet()
+    # Check if header exists, if not add it
+    existing_val = ws.acell('A1').value
+    if not existing_val:
+        headers = [
+            'Fecha Consulta', 'DNI', 'Sexo', 'CUIT',
+            # BCRA
+            'Nombre (BCRA)', 'Situación BCRA', 'Deuda Total',
+            'Entidades Reportando',
+            # AFIP
+            'Nombre (AFIP)', 'Estado CUIT', 'Tipo Persona',
+            'Condición Fiscal', 'Monotributista', 'Categoría Mono',
+            'Resp. Inscripto', 'Autónomo', 'Rel. Dependencia',
+            'Domicilio Fiscal', 'Actividades', 'Impuestos Activos'
+        ]
+        ws.append_row(headers)
+        # Format header row
+        ws.format('A1:T1', {
+            'textFormat': {'bold': True, 'foregroundColorStyle': {'rgbColor': {'red': 1, 'green': 1, 'blue': 1}}},
+            'backgroundColor': {'red': 0, 'green': 0.34, 'blue': 0.7},
+            'horizontalAlignment': 'CENTER'
+        })
+        ws.freeze(rows=1)
+    _save_state(SPREADSHEET_ID, True)
+
+
+# Index by truthiness for the boolean columns (hot in batched writes)
+_YN = ('No', 'Sí')
+
+
+def _build_row(data):
+    """Build the spreadsheet row for one consultation dict."""
+    # Same 'YYYY-MM-DD HH:MM:SS' output as strftime, via the C fast path
+    now = datetime.now().isoformat(' ', 'seconds')
+    bcra_get = data.get('bcra', {}).get
+    afip_get = data.get('afip', {}).get
+
+    # Format activities as comma-separated string (join on empty is already '')
+    actividades = ', '.join(afip_get('actividades') or ())
+
+    # Format active impuestos; a list comprehension feeds join faster than
+    # a generator
+    impuestos_activos = ', '.join([
+        imp.get('descripcion', '') for imp in (afip_get('impuestos') or ())
+        if imp.get('estado') == 'Activo'
+    ])
+
+    return [
+        now,
+        data.get('dni', ''),
+        data.get('sex', ''),
+        data.get('cuit', ''),
+        # BCRA — numerics go through as-is; the Sheets API accepts them
+        # directly, so stringifying here was pure overhead
+        bcra_get('name', ''),
+        bcra_get('situacion', ''),
+        bcra_get('deuda_total', ''),
+        bcra_get('entidades', ''),
+        # AFIP
+        afip_get('nombre', ''),
+        afip_get('estado_clave', ''),
+        afip_get('tipo_persona', ''),
+        afip_get('condicion_fiscal', ''),
+        _YN[bool(afip_get('is_monotributo'))],
+        afip_get('categoria_monotributo') or '',
+        _YN[bool(afip_get('is_responsable_inscripto'))],
+        _YN[bool(afip_get('is_autonomo'))],
+        _YN[bool(afip_get('is_relacion_dependencia'))],
+        afip_get('domicilio', ''),
+        actividades,
+        impuestos_activos
+    ]
 
 
-def _get_or_create_spreadsheet(user_email=None):
-    """Get the existing shared spreadsheet."""
-    gc = _get_client()
-    
-    # ID of the spreadsheet shared by the user
-    # Title: 'Comarfin users'
-    sid = '1ToLqnylV8AO_84Rk4tya0facoDJvxHwRfgTD1IRO9as'
+@_retry_on_429()
+def _append_rows(ws, rows):
+    """
+    Append rows to the worksheet, retrying quota/transient errors.
 
+    The hot path POSTs straight to spreadsheets.values.append on a
+    keep-alive AuthorizedSession — a single HTTP call, reusing one TLS
+    connection across saves — instead of going through gspread's
+    compatibility layers. If the direct call fails for any reason we fall
+    back to gspread's append_rows, whose APIErrors the retry decorator
+    understands.
+
+    Values go in RAW: the rows are already fully formatted strings, so
+    Sheets' server-side parsing (number/date coercion, formula detection)
+    is wasted work — and RAW also means a DNI typed as '=...' lands as a
+    literal string instead of executing as a formula.
+    """
     try:
-        sh = gc.open_by_key(sid)
-        _save_spreadsheet_id(sid)
-        
-        # Check if header exists, if not add it
-        ws = sh.sheet1
-        existing_val = ws.acell('A1').value
-        if not existing_val:
-            headers = [
-                'Fecha Consulta', 'DNI', 'Sexo', 'CUIT',
-                # BCRA
-                'Nombre (BCRA)', 'Situación BCRA', 'Deuda Total',
-                'Entidades Reportando',
-                # AFIP
-                'Nombre (AFIP)', 'Estado CUIT', 'Tipo Persona',
-                'Condición Fiscal', 'Monotributista', 'Categoría Mono',
-                'Resp. Inscripto', 'Autónomo', 'Rel. Dependencia',
-                'Domicilio Fiscal', 'Actividades', 'Impuestos Activos'
-            ]
-            ws.append_row(headers)
-            # Format header row
-            ws.format('A1:T1', {
-                'textFormat': {'bold': True, 'foregroundColorStyle': {'rgbColor': {'red': 1, 'green': 1, 'blue': 1}}},
-                'backgroundColor': {'red': 0, 'green': 0.34, 'blue': 0.7},
-                'horizontalAlignment': 'CENTER'
-            })
-            ws.freeze(rows=1)
-            
-        return sh
+        session = _get_authed_session()
+        resp = session.post(
+            f'https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}/values/A1:append',
+            params={'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'},
+            json={'values': rows},
+            timeout=30,
+        )
+        if resp.status_code == 200:
+            return
+        print(f"Direct values.append failed ({resp.status_code}), falling back to gspread")
     except Exception as e:
-        # Fallback if specific sheet differs or fails
-        print(f"Error accessing shared sheet: {e}")
-        # If we can't search by name easily without listing all, we might fallback to create
-        # But for now, let's Raise to see what happens or try to find by name if key fails
-        raise e
+        print(f"Direct values.append failed: {e}")
+
+    # table_range='A1' pins the append anchor, skipping Sheets' table
+    # auto-detection scan (slow once the sheet holds thousands of rows)
+    ws.append_rows(rows, value_input_option='RAW',
+                   insert_data_option='INSERT_ROWS', table_range='A1')
+
+
+# Background writer: save_consultation enqueues the row and returns
+# immediately; a daemon thread drains the queue in batches of up to 50,
+# so user-facing requests never wait out a multi-second Sheets round-trip
+# and bursts collapse into few append calls.
+_write_queue = queue.Queue()
+_writer_started = False
+_writer_lock = threading.Lock()
+
+# Token bucket keeping append calls under the Sheets per-user write
+# quota (300 requests/min); 290 leaves headroom for the bootstrap calls.
+_BUCKET_CAPACITY = 290.0
+_REFILL_PER_SEC = 290.0 / 60.0
+_bucket_tokens = _BUCKET_CAPACITY
+_bucket_stamp = time.monotonic()
+
+
+def _throttle_writes():
+    """Block (writer thread only) until a write token is available."""
+    global _bucket_tokens, _bucket_stamp
+    now = time.monotonic()
+    _bucket_tokens = min(_BUCKET_CAPACITY,
+                         _bucket_tokens + (now - _bucket_stamp) * _REFILL_PER_SEC)
+    _bucket_stamp = now
+    if _bucket_tokens < 1.0:
+        time.sleep((1.0 - _bucket_tokens) / _REFILL_PER_SEC)
+        _bucket_tokens = 1.0
+        _bucket_stamp = time.monotonic()
+    _bucket_tokens -= 1.0
+
+
+def _writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        try:
+            while len(batch) < 50:
+                batch.append(_write_queue.get(timeout=0.5))
+        except queue.Empty:
+            pass
+        try:
+            _throttle_writes()
+            save_consultations(batch)
+        except Exception as e:
+            print(f"Error saving batch of {len(batch)} consultations: {e}")
+        finally:
+            for _ in batch:
+                _write_queue.task_done()
+
+
+def _ensure_writer():
+    global _writer_started
+    if not _writer_started:
+        with _writer_lock:
+            if not _writer_started:
+                threading.Thread(target=_writer_loop, daemon=True,
+                                 name='sheets-writer').start()
+                _writer_started = True
+
+
+def flush_consultations():
+    """Block until every queued consultation has been written (shutdown hook)."""
+    _write_queue.join()
+
+
+# Recently written consultations, keyed (dni, cuit, hour). Retries and
+# page refreshes re-save the same person within minutes; each duplicate
+# row costs a quota unit, so repeats within the hour are dropped. Capped
+# so the map can't grow unbounded on a long-lived worker.
+_recent = OrderedDict()
+_RECENT_MAX = 1024
+_recent_lock = threading.Lock()
 
 
 def save_consultation(data):
     """
-    Save a consultation result to Google Sheets.
-    
+    Queue a consultation result for saving to Google Sheets.
+
+    Returns the spreadsheet URL immediately; the actual write happens on
+    the background writer thread, batched with any neighbours. A repeat
+    of the same DNI/CUIT within the hour is deduplicated instead of
+    producing another row. Write failures are retried by the writer and
+    logged rather than surfaced to the HTTP caller.
+
     data should contain:
     - dni, sex, cuit
     - bcra: {name, situacion, deuda_total, entidades}
-    - afip: {nombre, estado_clave, tipo_persona, condicion_fiscal, 
+    - afip: {nombre, estado_clave, tipo_persona, condicion_fiscal,
              is_monotributo, categoria_monotributo, is_responsable_inscripto,
              is_autonomo, is_relacion_dependencia, domicilio, actividades, impuestos}
     """
-    sh = _get_or_create_spreadsheet()
-    ws = sh.sheet1
+    # 'YYYY-MM-DD HH' — same key for every save within the hour
+    key = (data.get('dni'), data.get('cuit'),
+           datetime.now().isoformat(' ', 'seconds')[:13])
+    with _recent_lock:
+        if key in _recent:
+            return SPREADSHEET_URL
+        _recent[key] = True
+        while len(_recent) > _RECENT_MAX:
+            _recent.popitem(last=False)
 
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    bcra = data.get('bcra', {})
-    afip = data.get('afip', {})
+    _ensure_writer()
+    _write_queue.put(data)
+    return SPREADSHEET_URL
 
-    # Format activities as comma-separated string
-    actividades = ', '.join(afip.get('actividades', [])) if afip.get('actividades') else ''
 
-    # Format active impuestos
-    impuestos_list = afip.get('impuestos', [])
-    impuestos_activos = ', '.join(
-        imp.get('descripcion', '') for imp in impuestos_list if imp.get('estado') == 'Activo'
-    ) if impuestos_list else ''
+def save_consultations(data_list):
+    """
+    Save several consultation results in a single append_rows round-trip.
 
-    row = [
-        now,
-        data.get('dni', ''),
-        data.get('sex', ''),
-        str(data.get('cuit', '')),
-        # BCRA
-        bcra.get('name', ''),
-        str(bcra.get('situacion', '')),
-        str(bcra.get('deuda_total', '')),
-        str(bcra.get('entidades', '')),
-        # AFIP
-        afip.get('nombre', ''),
-        afip.get('estado_clave', ''),
-        afip.get('tipo_persona', ''),
-        afip.get('condicion_fiscal', ''),
-        'Sí' if afip.get('is_monotributo') else 'No',
-        afip.get('categoria_monotributo', '') or '',
-        'Sí' if afip.get('is_responsable_inscripto') else 'No',
-        'Sí' if afip.get('is_autonomo') else 'No',
-        'Sí' if afip.get('is_relacion_dependencia') else 'No',
-        afip.get('domicilio', ''),
-        actividades,
-        impuestos_activos
-    ]
+    One batched call costs the same quota and latency as one append_row,
+    so N consultations collapse from N Sheets round-trips into one.
+    """
+    ws = _open_worksheet()
 
-    ws.append_row(row, value_input_option='USER_ENTERED')
-    return sh.url
+    rows = [_build_row(data) for data in data_list]
+    if rows:
+        _append_rows(ws, rows)
+    return SPREADSHEET_URL
 
 
 def get_spreadsheet_url():
     """Get the URL of the existing spreadsheet."""
-    sid = _get_spreadsheet_id()
-    if sid:
-        return f'https://docs.google.com/spreadsheets/d/{sid}'
-    return None
+    return SPREADSHEET_URL
+
+
+# With SHEETS_EAGER_INIT=1, authenticate at import time: gunicorn runs
+# with preload_app (see gunicorn.conf.py), so the credentials and client
+# are built once in the master and inherited copy-on-write by every
+# worker instead of each doing its own OAuth exchange. Left opt-in so a
+# misconfigured credential can't break imports; workers without it still
+# share the refreshed token via the /tmp cache.
+if os.environ.get('SHEETS_EAGER_INIT') == '1':
+    try:
+        _get_client()
+    except Exception as e:
+        print(f"Eager Sheets init failed: {e}")